@@ -116,14 +116,32 @@ def sync_shared_params(model: torch.nn.Module, process_group: ProcessGroup):
             )
 
 
-# Ref: https://github.com/NVIDIA/Megatron-LM/blob/52e636888cccc41e931251c417a7181fc36de926/megatron/optimizer/optimizer.py#L256
-def allreduce_sequence_parallel_grad(model: torch.nn.Module, process_group: ProcessGroup):
+def get_sequence_parallel_params(model: torch.nn.Module):
     # We want to iterate over parameters with _sequence_parallel=True in the same order,
     # as different ranks might have different number of parameters (e.g., only rank 0 has bias).
-    params_seqparallel = {
-        name: p for name, p in model.named_parameters() if getattr(p, "_sequence_parallel", False)
-    }
-    grads = [p.grad for _, p in sorted(params_seqparallel.items())]
+    # The sorted (name, param) pairs are cached on the model so that we don't filter and sort
+    # every step. The cache is rebuilt if the number of parameters changed or if any cached
+    # parameter was replaced (e.g. by load_state_dict(assign=True)).
+    num_params = sum(1 for _ in model.parameters())
+    cache = getattr(model, "_sequence_parallel_params", None)
+    if (
+        cache is None
+        or cache[0] != num_params
+        or any(model.get_parameter(name) is not p for name, p in cache[1])
+    ):
+        params_seqparallel = {
+            name: p
+            for name, p in model.named_parameters()
+            if getattr(p, "_sequence_parallel", False)
+        }
+        cache = (num_params, sorted(params_seqparallel.items()))
+        model._sequence_parallel_params = cache
+    return [p for _, p in cache[1]]
+
+
+# Ref: https://github.com/NVIDIA/Megatron-LM/blob/52e636888cccc41e931251c417a7181fc36de926/megatron/optimizer/optimizer.py#L256
+def allreduce_sequence_parallel_grad(model: torch.nn.Module, process_group: ProcessGroup):
+    grads = [p.grad for p in get_sequence_parallel_params(model)]
     if grads:
         with torch.no_grad():
             coalesced = torch._utils._flatten_dense_tensors(grads)
@@ -132,6 +150,70 @@ def allreduce_sequence_parallel_grad(model: torch.nn.Module, process_group: Proc
                 buf.copy_(synced)
 
 
+def allreduce_sequence_parallel_grad_async(model: torch.nn.Module, process_group: ProcessGroup):
+    """All-reduce the sequence-parallel grads during the backward pass, one bucket per module.
+
+    The buckets are launched in reverse order of module registration, each one as soon as all of
+    its grads (and those of the previous buckets) have been accumulated. E.g. in a Block, the
+    all-reduce of norm2's grads overlaps with the backward of the mixer and of norm1.
+
+    Call this before .backward() and call the returned function after .backward() to wait for
+    the all-reduces and copy the results back into the grads. The returned function must always
+    be called, even if .backward() raises (e.g. in a finally block), as it removes the hooks.
+    It raises if .backward() didn't accumulate all the sequence-parallel grads.
+    """
+    # PyTorch < 2.1 has no post-accumulate grad hook, fall back to all-reducing after backward.
+    if not hasattr(torch.Tensor, "register_post_accumulate_grad_hook"):
+
+        def wait():
+            allreduce_sequence_parallel_grad(model, process_group)
+
+        return wait
+
+    # The order in which autograd runs the hooks is not guaranteed to be the same on all ranks,
+    # so the hooks only record which grads are ready, and the buckets are always launched in the
+    # same order: reverse module registration order, which roughly follows the backward pass.
+    buckets = {}
+    for name, p in model.named_parameters():
+        if getattr(p, "_sequence_parallel", False):
+            buckets.setdefault(name.rpartition(".")[0], {})[name] = p
+    buckets = [[p for _, p in sorted(bucket.items())] for bucket in reversed(buckets.values())]
+    ready = set()
+    launched = []
+
+    def allreduce_hook(p: Tensor):
+        ready.add(p)
+        while len(launched) < len(buckets) and all(
+            param in ready for param in buckets[len(launched)]
+        ):
+            grads = [param.grad for param in buckets[len(launched)]]
+            with torch.no_grad():
+                coalesced = torch._utils._flatten_dense_tensors(grads)
+                handle = torch.distributed.all_reduce(coalesced, group=process_group, async_op=True)
+            launched.append((coalesced, handle))
+
+    hooks = [p.register_post_accumulate_grad_hook(allreduce_hook) for b in buckets for p in b]
+
+    def wait():
+        for hook in hooks:
+            hook.remove()
+        for bucket, (coalesced, handle) in zip(buckets, launched):
+            handle.wait()
+            grads = [p.grad for p in bucket]
+            with torch.no_grad():
+                for buf, synced in zip(
+                    grads, torch._utils._unflatten_dense_tensors(coalesced, grads)
+                ):
+                    buf.copy_(synced)
+        if len(launched) < len(buckets):
+            raise RuntimeError(
+                f"Only {len(launched)} of {len(buckets)} buckets of sequence-parallel grads were "
+                "all-reduced, as backward didn't accumulate all the sequence-parallel grads"
+            )
+
+    return wait
+
+
 def get_dim_for_local_rank(dim: int, world_size: int, local_rank: int, multiple_of: int = 1) -> int:
     """Get the dim for the local rank derived from splitting dim on world_size processes.
 